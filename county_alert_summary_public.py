@@ -1,9 +1,14 @@
+import hashlib
+import os
+import pickle
+from collections import defaultdict
 from datetime import datetime, timezone
 from utils_public_layer import (
-    get_json,
+    CACHE_DIR,
+    iter_paginated,
     pick_polygon_layer,
     layer_urls,
-    query_all,
+    query_all_parallel,
     apply_updates,
 )
 
@@ -14,71 +19,177 @@ SERVICE_ROOT = (
 
 BASE_ALERTS = "https://api.weather.gov/alerts/active"
 
-ALLOW_EVENTS = set()
+# Leave empty to accept every event; membership is O(1) when populated.
+ALLOW_EVENTS = frozenset()
 
 
 def iter_active_alert_props():
+    # Decide the filter once instead of re-testing ALLOW_EVENTS per alert.
+    accept = (lambda ev: True) if not ALLOW_EVENTS else ALLOW_EVENTS.__contains__
+
     url = f"{BASE_ALERTS}?status=actual&message_type=alert"
-    while url:
-        data = get_json(url)
+    for data in iter_paginated(url):
         for feat in data.get("features", []):
             p = feat.get("properties", {})
-            ev = p.get("event")
-            if not ALLOW_EVENTS or ev in ALLOW_EVENTS:
+            if accept(p.get("event")):
                 yield p
-        url = data.get("pagination", {}).get("next")
+
+
+# Index of each tag within the per-UGC (warning, watch, advisory) lists.
+_TAG_INDEX = {"warning": 0, "watch": 1, "advisory": 2}
+
+# Update rows are kept as parallel columns (structure-of-arrays) and
+# only materialized into applyEdits attribute dicts at serialization
+# time, instead of allocating a nested dict per county up front.
+_ROW_FIELDS = ("status_level", "warning_count", "warning_names",
+               "watch_count", "watch_names", "advisory_count",
+               "advisory_names")
+
+# Summary row for a county with no active alerts — the common case by
+# far, emitted without any sort/join work.
+_EMPTY_ROW = (0, 0, None, 0, None, 0, None)
+
+
+def _new_update_cols():
+    cols = {"oid": [], "summary_hash": []}
+    for name in _ROW_FIELDS:
+        cols[name] = []
+    return cols
+
+
+def _append_row(cols, oid, digest, row):
+    cols["oid"].append(oid)
+    cols["summary_hash"].append(digest)
+    for name, value in zip(_ROW_FIELDS, row):
+        cols[name].append(value)
+
+
+def _iter_updates(cols, oid_field, now, include_hash):
+    for i in range(len(cols["oid"])):
+        attrs = {
+            oid_field: cols["oid"][i],
+            "last_updated": now,
+        }
+        if include_hash:
+            attrs["summary_hash"] = cols["summary_hash"][i]
+        for name in _ROW_FIELDS:
+            attrs[name] = cols[name][i]
+        yield {"attributes": attrs}
+
+# NWS event names come from a small fixed vocabulary (~80), so the
+# cache saturates quickly and repeat alerts skip the substring scans.
+_TAG_CACHE = {}
 
 
 def ww_tag(event_text: str):
-    e = (event_text or "").lower()
-    if "warning" in e:
-        return "warning"
-    if "watch" in e:
-        return "watch"
-    return "advisory"
+    tag = _TAG_CACHE.get(event_text)
+    if tag is None:
+        e = (event_text or "").lower()
+        if "warning" in e:
+            tag = "warning"
+        elif "watch" in e:
+            tag = "watch"
+        else:
+            tag = "advisory"
+        _TAG_CACHE[event_text] = tag
+    return tag
 
 
 def now_iso():
     return datetime.now(timezone.utc).isoformat()
 
 
+# Last-run UGC -> summary_hash map, kept as a secondary change check for
+# layers that do not (yet) expose a summary_hash field.
+_HASH_SNAPSHOT = os.path.join(CACHE_DIR, "summary_hash.pkl")
+
+
+def summary_hash(row) -> str:
+    """Stable 16-char digest of a county's summary values (_ROW_FIELDS order)."""
+    return hashlib.blake2s(repr(row).encode(), digest_size=8).hexdigest()
+
+
+_EMPTY_HASH = summary_hash(_EMPTY_ROW)
+
+
+def _load_hash_snapshot():
+    try:
+        with open(_HASH_SNAPSHOT, "rb") as fh:
+            return pickle.load(fh)
+    except (OSError, pickle.PickleError):
+        return {}
+
+
+def _save_hash_snapshot(hashes):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(_HASH_SNAPSHOT, "wb") as fh:
+        pickle.dump(hashes, fh)
+
+
 def main():
     layer_id, layer_info = pick_polygon_layer(SERVICE_ROOT)
     urls = layer_urls(SERVICE_ROOT, layer_id)
     oid_field = layer_info.get("objectIdField", "OBJECTID")
 
-    agg = {}
+    # Per UGC: (warning, watch, advisory) event-name lists. Appending
+    # duplicates is cheaper than hashing into sets per alert; dedupe
+    # happens once per county at emit time.
+    agg = defaultdict(lambda: ([], [], []))
     for p in iter_active_alert_props():
         event_name = p.get("event")
-        tag = ww_tag(event_name)
+        idx = _TAG_INDEX[ww_tag(event_name)]
         ugcs = (p.get("geocode") or {}).get("UGC") or []
-        county_ugcs = [u for u in ugcs if len(u) > 2 and u[2] == "C"]
-        for ugc in county_ugcs:
-            rec = agg.setdefault(ugc, {"warn": set(), "watch": set(), "adv": set()})
-            if tag == "warning":
-                rec["warn"].add(event_name)
-            elif tag == "watch":
-                rec["watch"].add(event_name)
-            else:
-                rec["adv"].add(event_name)
+        for ugc in ugcs:
+            if len(ugc) < 3 or ugc[2] != "C":
+                continue
+            agg[ugc][idx].append(event_name)
 
     print(f"Aggregated alerts for {len(agg)} county UGCs.")
 
-    updates = []
+    cols = _new_update_cols()
     now = now_iso()
     county_count = 0
 
-    for f in query_all(urls["query"], f"{oid_field},ugc,county_name"):
+    prev_hashes = _load_hash_snapshot()
+    new_hashes = {}
+
+    # Stay within the layer's page cap: oversized windows would come
+    # back truncated and the parallel offsets would skip rows.
+    max_rec = layer_info.get("maxRecordCount") or 5000
+
+    # Only query/write summary_hash where the layer actually has the
+    # field — asking for an unknown field makes ArcGIS return an error
+    # body, which reads as zero features. Without it the local pickle
+    # snapshot is the sole change check.
+    layer_fields = {fld.get("name") for fld in layer_info.get("fields") or []}
+    has_hash_field = "summary_hash" in layer_fields
+
+    out_fields = f"{oid_field},ugc,county_name"
+    if has_hash_field:
+        out_fields += ",summary_hash"
+
+    for f in query_all_parallel(
+        urls["query"],
+        out_fields,
+        chunk=min(5000, max_rec),
+    ):
         a = f.get("attributes", {})
         oid = a.get(oid_field)
         ugc = a.get("ugc")
 
         county_count += 1
-        rec = agg.get(ugc, {"warn": set(), "watch": set(), "adv": set()})
+        lists = agg.get(ugc)
+
+        if lists is None:
+            new_hashes[ugc] = _EMPTY_HASH
+            if (a.get("summary_hash") or prev_hashes.get(ugc)) == _EMPTY_HASH:
+                continue
+            _append_row(cols, oid, _EMPTY_HASH, _EMPTY_ROW)
+            continue
 
-        warning_names = sorted(rec["warn"])
-        watch_names = sorted(rec["watch"])
-        adv_names = sorted(rec["adv"])
+        warning_names = sorted(set(lists[0]))
+        watch_names = sorted(set(lists[1]))
+        adv_names = sorted(set(lists[2]))
 
         warning_count = len(warning_names)
         watch_count = len(watch_names)
@@ -86,31 +197,47 @@ def main():
 
         status_level = 2 if warning_count > 0 else (1 if watch_count > 0 else 0)
 
-        updates.append(
-            {
-                "attributes": {
-                    oid_field: oid,
-                    "status_level": status_level,
-                    "warning_count": warning_count,
-                    "warning_names": "; ".join(warning_names) if warning_names else None,
-                    "watch_count": watch_count,
-                    "watch_names": "; ".join(watch_names) if watch_names else None,
-                    "advisory_count": advisory_count,
-                    "advisory_names": "; ".join(adv_names) if adv_names else None,
-                    "last_updated": now,
-                }
-            }
+        row = (
+            status_level,
+            warning_count,
+            "; ".join(warning_names) if warning_names else None,
+            watch_count,
+            "; ".join(watch_names) if watch_names else None,
+            advisory_count,
+            "; ".join(adv_names) if adv_names else None,
         )
 
-    print(f"Read {county_count} counties; prepared {len(updates)} updates.")
+        new_hash = summary_hash(row)
+        new_hashes[ugc] = new_hash
+        if (a.get("summary_hash") or prev_hashes.get(ugc)) == new_hash:
+            continue
 
-    if not updates:
+        _append_row(cols, oid, new_hash, row)
+
+    n_updates = len(cols["oid"])
+    print(f"Read {county_count} counties; prepared {n_updates} updates "
+          f"({county_count - n_updates} unchanged).")
+
+    if not n_updates:
         print("No summary updates required.")
+        # A zero-county read means the query failed, not that nothing
+        # changed — keep the previous snapshot in that case.
+        if county_count:
+            _save_hash_snapshot(new_hashes)
         return
 
-    total = apply_updates(urls["applyEdits"], updates, batch=500, sleep=0.2)
+    total = apply_updates(
+        urls["applyEdits"],
+        _iter_updates(cols, oid_field, now, has_hash_field),
+        batch=500,
+    )
     print(f"Updated {total} counties (layer {layer_id}).")
 
+    # Only trust the snapshot when every row landed; otherwise the
+    # missed rows must be retried on the next run.
+    if total == n_updates:
+        _save_hash_snapshot(new_hashes)
+
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,18 @@
+import difflib
 import re
+from functools import lru_cache
+
+try:
+    from rapidfuzz import process as _rf_process
+    from rapidfuzz.distance import DamerauLevenshtein as _rf_scorer
+except ImportError:  # optional: falls back to stdlib difflib
+    _rf_process = None
+
 from utils_public_layer import (
-    get_json,
+    iter_paginated,
     pick_polygon_layer,
     layer_urls,
-    query_all,
+    query_all_parallel,
     apply_updates,
 )
 
@@ -18,33 +27,78 @@ FIELD_UGC = "ugc"
 
 ZONES_INDEX = "https://api.weather.gov/zones?type=county"
 
+FUZZY_MIN_SCORE = 0.88
+
+# Precompiled patterns and byte tables: normalization runs per county
+# name, so the fold and strip steps are byte-level translate calls.
+# Suffix removal keeps a (precompiled, bytes) regex — it needs word
+# boundaries, or names like Hillsborough would lose their embedded
+# "borough". slug keeps the str regex: a maketrans deletion table only
+# covers code points 0-255 and would let Unicode punctuation through.
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9]+")
+_LOWER_B = bytes(range(256)).lower()
+_NON_ALNUM_DROP_B = bytes(
+    c for c in range(256) if not (97 <= c <= 122 or 48 <= c <= 57)
+)
+_SUFFIX_RE_B = re.compile(
+    rb"\b(county|parish|borough|city|census area|municipality)\b"
+)
+
 
 def slug(s: str) -> str:
-    return re.sub(r"[^a-z0-9]+", "", (s or "").lower())
+    return _NON_ALNUM_RE.sub("", (s or "").lower())
 
 
+@lru_cache(maxsize=None)
 def normalize_name(name: str) -> str:
     """
     Normalize county names to improve matching.
     Removes suffixes like County/Parish/Borough and fixes prefixes.
+
+    Cached: names like Washington or Jefferson repeat across dozens of
+    states, and the zone-index and layer passes see the same strings.
     """
 
     if not name:
         return ""
 
-    n = name.lower()
+    # errors="replace" keeps a "?" where a non-ASCII character sat, so
+    # the suffix regex still sees a word boundary there (an en dash
+    # before "county", say); the final translate drops the "?" anyway.
+    b = name.encode("ascii", "replace").translate(_LOWER_B)
 
-   
-    n = re.sub(r"\b(county|parish|borough|city|census area|municipality)\b", "", n)
+    b = _SUFFIX_RE_B.sub(b"", b)
 
-   
-    n = n.replace("saint ", "st ")
-    n = n.replace("sainte ", "ste ")
+    b = b.replace(b"saint ", b"st ")
+    b = b.replace(b"sainte ", b"ste ")
 
-    
-    n = re.sub(r"[^a-z0-9]+", "", n)
+    return b.translate(None, _NON_ALNUM_DROP_B).decode("ascii")
 
-    return n
+
+def fuzzy_match_keys(keys, choices):
+    """
+    Best fuzzy-matching choice per key, or None when nothing scores at
+    least FUZZY_MIN_SCORE. Uses RapidFuzz's C++ kernel (all cores, GIL
+    released) when installed, else stdlib difflib.
+    """
+    if _rf_process is not None:
+        scores = _rf_process.cdist(
+            keys,
+            choices,
+            scorer=_rf_scorer.normalized_similarity,
+            workers=-1,
+        )
+        out = []
+        for row in scores:
+            best = max(range(len(choices)), key=row.__getitem__)
+            out.append(choices[best] if row[best] >= FUZZY_MIN_SCORE else None)
+        return out
+
+    return [
+        (difflib.get_close_matches(k, choices, n=1, cutoff=FUZZY_MIN_SCORE)
+         or [None])[0]
+        for k in keys
+    ]
 
 
 def build_zone_index():
@@ -54,12 +108,10 @@ def build_zone_index():
     print("Fetching NWS county zones…")
 
     by_state = {}
-    url = ZONES_INDEX
 
     zone_samples = []
 
-    while url:
-        data = get_json(url)
+    for data in iter_paginated(ZONES_INDEX):
         feats = data.get("features", [])
 
         for z in feats:
@@ -78,8 +130,6 @@ def build_zone_index():
 
             by_state.setdefault(state.upper(), {})[key] = ugc
 
-        url = data.get("pagination", {}).get("next")
-
     print("Zone index built.")
     return by_state
 
@@ -92,19 +142,31 @@ def main():
     oid_field = layer_info.get("objectIdField", "OBJECTID")
 
     zone_index = build_zone_index()
-    updates = []
 
-    county_count = 0
-    matched_count = 0
+    # Matched rows as parallel columns; the applyEdits dicts are built
+    # lazily at serialization time.
+    upd_oids = []
+    upd_ugcs = []
+    unmatched = []
 
-    for f in query_all(
-        urls["query"],
-        f"{oid_field},{FIELD_STATE_ABBR},{FIELD_COUNTY_NAME},{FIELD_UGC}",
-    ):
-        a = f.get("attributes", {})
-        county_count += 1
+    matched_count = 0
 
-        
+    attrs = [
+        f.get("attributes", {})
+        for f in query_all_parallel(
+            urls["query"],
+            f"{oid_field},{FIELD_STATE_ABBR},{FIELD_COUNTY_NAME},{FIELD_UGC}",
+            chunk=min(5000, layer_info.get("maxRecordCount") or 5000),
+        )
+    ]
+    county_count = len(attrs)
+
+    # Normalize the whole name column in one pass before matching; the
+    # cached byte kernel makes the many repeated names (Washington,
+    # Jefferson, ...) a dict hit instead of rework.
+    keys = [normalize_name(a.get(FIELD_COUNTY_NAME) or "") for a in attrs]
+
+    for a, key in zip(attrs, keys):
         if a.get(FIELD_UGC):
             continue
 
@@ -114,29 +176,46 @@ def main():
         if not (state and raw_name):
             continue
 
-        key = normalize_name(raw_name)
-
         ugc = zone_index.get(state, {}).get(key)
 
         if ugc:
             matched_count += 1
-            updates.append({
-                "attributes": {
-                    oid_field: a.get(oid_field),
-                    FIELD_UGC: ugc
-                }
-            })
+            upd_oids.append(a.get(oid_field))
+            upd_ugcs.append(ugc)
         else:
-           
-            print(f"[NO MATCH] {state} - {raw_name} -> key='{key}'")
+            unmatched.append((a.get(oid_field), state, raw_name, key))
+
+    # Second pass: resolve leftovers fuzzily against the in-state zone
+    # names (typically spelling variants the normalizer cannot bridge).
+    by_match_state = {}
+    for oid, state, raw_name, key in unmatched:
+        by_match_state.setdefault(state, []).append((oid, raw_name, key))
+
+    for state, group in by_match_state.items():
+        choices = list(zone_index.get(state, {}))
+        hits = fuzzy_match_keys([k for _, _, k in group], choices) if choices \
+            else [None] * len(group)
+
+        for (oid, raw_name, key), hit in zip(group, hits):
+            if hit:
+                matched_count += 1
+                upd_oids.append(oid)
+                upd_ugcs.append(zone_index[state][hit])
+                print(f"[FUZZY] {state} - {raw_name} -> '{hit}'")
+            else:
+                print(f"[NO MATCH] {state} - {raw_name} -> key='{key}'")
 
     print(f"Counties processed: {county_count}")
     print(f"Counties matched with UGC: {matched_count}")
 
-    if not updates:
+    if not upd_oids:
         print("No UGC updates needed.")
         return
 
+    updates = (
+        {"attributes": {oid_field: oid, FIELD_UGC: ugc}}
+        for oid, ugc in zip(upd_oids, upd_ugcs)
+    )
     total = apply_updates(urls["applyEdits"], updates)
     print(f"UGC updated on {total} counties (layer {layer_id}).")
 
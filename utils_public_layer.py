@@ -1,36 +1,232 @@
-import re, json, time, requests
-from typing import Dict, List, Tuple
+import hashlib, os, re, json, time, requests
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from typing import Dict, Iterable, List, Tuple
+
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+from urllib3.util.retry import Retry
+
+try:
+    import ijson
+except ImportError:  # optional: falls back to buffered parsing
+    ijson = None
+
+try:
+    import orjson
+except ImportError:  # optional: falls back to stdlib json
+    orjson = None
+
+if orjson is not None:
+    _loads = orjson.loads
+
+    def _dumps(obj):
+        return orjson.dumps(obj).decode()
+else:
+    _loads = json.loads
+    _dumps = json.dumps
 
 USER_AGENT = "Class-Project/1.0 (contact: example@class.edu)"
 
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ewd")
+
+# One session for the whole process: pooled keep-alive connections skip
+# the per-call TCP+TLS handshake, and retries with backoff are handled
+# at the transport layer.
+_SESSION = requests.Session()
+_SESSION.headers.update({
+    "User-Agent": USER_AGENT,
+    "Accept-Encoding": "gzip",
+})
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        # urllib3 excludes POST by default; applyEdits batches update
+        # fixed OIDs, so replaying one is safe and must be retried for
+        # the concurrent upload path to survive throttling.
+        allowed_methods=frozenset({"GET", "POST"}),
+    ),
+)
+_SESSION.mount("https://", _adapter)
+_SESSION.mount("http://", _adapter)
+
 
 def get_json(url: str, params: Dict = None, method: str = "GET",
              data: Dict = None, timeout: int = 30):
-    headers = {"User-Agent": USER_AGENT}
     if method == "GET":
-        r = requests.get(url, params=params, headers=headers, timeout=timeout)
+        r = _SESSION.get(url, params=params, timeout=timeout)
     else:
-        r = requests.post(url, data=data, headers=headers, timeout=timeout)
+        r = _SESSION.post(url, data=data, timeout=timeout)
+    r.raise_for_status()
+    return _loads(r.content)
+
+
+def _cache_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, f"{hashlib.blake2s(key.encode()).hexdigest()}.json")
+
+
+def _read_cache_file(path: str, ttl: int):
+    """Parsed cache entry, or None if missing, stale, or unreadable."""
+    try:
+        if time.time() - os.path.getmtime(path) >= ttl:
+            return None
+        with open(path, "rb") as fh:
+            return _loads(fh.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cache_file(path: str, data: bytes):
+    # Write-then-rename so a crashed run can't leave a truncated file
+    # that fails to parse until the TTL expires.
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp, path)
+
+
+def cached_get_json(url: str, ttl: int = 86400):
+    """
+    get_json with an on-disk cache keyed by URL, for service/layer
+    metadata that is stable across runs. Entries older than `ttl`
+    seconds are refetched; the raw response bytes are stored as-is.
+    """
+    path = _cache_path(url)
+
+    cached = _read_cache_file(path, ttl)
+    if cached is not None:
+        return cached
+
+    r = _SESSION.get(url, timeout=30)
+    r.raise_for_status()
+    js = _loads(r.content)
+
+    # ArcGIS delivers errors in a 200 body; caching one would brick
+    # the caller for a whole TTL over a transient failure.
+    if not (isinstance(js, dict) and "error" in js):
+        _write_cache_file(path, r.content)
+
+    return js
+
+
+def get_json_stream(url: str, params: Dict = None,
+                    item_path: str = "features.item", timeout: int = 60):
+    """
+    Yield items from a JSON array response as bytes arrive, instead of
+    buffering the body and materializing the whole document. Keeps peak
+    memory at one item and overlaps parsing with the network receive.
+    Requires ijson.
+    """
+    r = _SESSION.get(url, params=params, timeout=timeout, stream=True)
     r.raise_for_status()
-    return r.json()
+    r.raw.decode_content = True  # let urllib3 gunzip the raw stream
+    try:
+        for item in ijson.items(r.raw, item_path):
+            yield item
+    finally:
+        r.close()
+
+
+def get_json_many(urls: List[str], workers: int = 16):
+    """
+    Fetch several independent URLs concurrently, yielding each parsed
+    JSON body as its request completes (order is not preserved).
+    """
+    if not urls:
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(get_json, u) for u in urls]
+        for fut in as_completed(futures):
+            yield fut.result()
+
+
+def iter_paginated(url: str):
+    """
+    Walk a `pagination.next` chain, yielding one page of parsed JSON
+    at a time. The next page is fetched in the background while the
+    caller consumes the current one, so the per-page RTT overlaps with
+    parsing instead of adding to it.
+    """
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        fut = pool.submit(get_json, url)
+        while fut is not None:
+            data = fut.result()
+            next_url = data.get("pagination", {}).get("next")
+            fut = pool.submit(get_json, next_url) if next_url else None
+            yield data
+
+
+def _probe_layer_meta(layer_url: str, ttl: int = 86400):
+    """
+    Read just geometryType and name from a layer's metadata. With ijson
+    the response is parsed incrementally and abandoned once both keys
+    are seen, skipping the bulk of the document (fields, domains,
+    renderer definitions); without it the cached full document is used.
+    Probe results are disk-cached like the full metadata, so warm
+    starts skip the round trip entirely.
+    """
+    if ijson is None:
+        info = cached_get_json(f"{layer_url}?f=json")
+        return info.get("geometryType"), info.get("name")
+
+    path = _cache_path(f"{layer_url}#probe")
+    cached = _read_cache_file(path, ttl)
+    if cached is not None:
+        return cached.get("geometryType"), cached.get("name")
+
+    r = _SESSION.get(layer_url, params={"f": "json"}, timeout=30, stream=True)
+    r.raise_for_status()
+    r.raw.decode_content = True
+    geom = name = None
+    try:
+        for key, value in ijson.kvitems(r.raw, ""):
+            if key == "geometryType":
+                geom = value
+            elif key == "name":
+                name = value
+            if geom is not None and name is not None:
+                break
+    finally:
+        r.close()
+
+    # A body with neither key is an ArcGIS error document (delivered
+    # with HTTP 200) — serve it once but don't persist it, mirroring
+    # cached_get_json's handling, so the next run retries the network.
+    if geom is not None or name is not None:
+        _write_cache_file(
+            path, _dumps({"geometryType": geom, "name": name}).encode()
+        )
+    return geom, name
 
 
 def pick_polygon_layer(service_root: str) -> Tuple[int, Dict]:
-    root = get_json(f"{service_root}?f=json")
+    root = cached_get_json(f"{service_root}?f=json")
     layers = root.get("layers", [])
     candidates = []
     for lyr in layers:
-        info = get_json(f"{service_root}/{lyr['id']}?f=json")
-        if info.get("geometryType") == "esriGeometryPolygon":
-            name = (info.get("name") or "").lower()
-            score = 2 if re.search(r"\bcount(y|ies)\b", name) else 1
-            candidates.append((score, lyr["id"], info))
+        geom, name = _probe_layer_meta(f"{service_root}/{lyr['id']}")
+        if geom == "esriGeometryPolygon":
+            score = 2 if re.search(r"\bcount(y|ies)\b", (name or "").lower()) else 1
+            candidates.append((score, lyr["id"]))
 
     if not candidates:
         raise RuntimeError("No polygon layers found.")
 
     candidates.sort(key=lambda x: (-x[0], x[1]))
-    _, layer_id, layer_info = candidates[0]
+    _, layer_id = candidates[0]
+
+    # Full metadata only for the chosen layer (objectIdField,
+    # maxRecordCount, ...); the losers never get fully parsed.
+    layer_info = cached_get_json(f"{service_root}/{layer_id}?f=json")
     return layer_id, layer_info
 
 
@@ -43,8 +239,27 @@ def layer_urls(service_root: str, layer_id: int) -> Dict[str, str]:
     }
 
 
+_MIN_CHUNK = 250
+
+# Failures that can surface mid-page. requests only wraps errors on its
+# own content paths; the ijson branch reads r.raw directly, where
+# urllib3 (ProtocolError, ReadTimeoutError) and ijson (truncated body)
+# raise their own types.
+_PAGE_ERRORS = (requests.RequestException, Urllib3HTTPError)
+if ijson is not None:
+    _PAGE_ERRORS = _PAGE_ERRORS + (ijson.IncompleteJSONError,)
+
+
 def query_all(layer_query_url: str, out_fields: str,
-              where: str = "1=1", chunk: int = 5000):
+              where: str = "1=1", chunk: int = 5000,
+              max_chunk: int = 20000):
+    """
+    Page through a layer query, adapting the page size to the server:
+    fast responses double `chunk` (up to `max_chunk`, e.g. the layer's
+    maxRecordCount), slow or failed ones halve it. Targets roughly one
+    to two seconds per page so throttled services degrade gracefully
+    instead of timing out on oversized requests.
+    """
     offset = 0
     while True:
         params = {
@@ -55,13 +270,72 @@ def query_all(layer_query_url: str, out_fields: str,
             "resultOffset": offset,
             "resultRecordCount": chunk,
         }
-        js = get_json(layer_query_url, params=params)
-        feats = js.get("features", [])
-        if not feats:
+        count = 0
+        started = time.perf_counter()
+        try:
+            if ijson is not None:
+                for f in get_json_stream(layer_query_url, params=params):
+                    count += 1
+                    yield f
+            else:
+                page = get_json(layer_query_url, params=params)
+                for f in page.get("features", []):
+                    count += 1
+                    yield f
+        except _PAGE_ERRORS:
+            if chunk <= _MIN_CHUNK:
+                raise
+            # Resume past whatever was already yielded with a smaller page.
+            chunk = max(chunk // 2, _MIN_CHUNK)
+            offset += count
+            continue
+
+        if count == 0:
             return
-        for f in feats:
-            yield f
-        offset += len(feats)
+        offset += count
+
+        duration = time.perf_counter() - started
+        if duration < 0.5:
+            chunk = min(chunk * 2, max_chunk)
+        elif duration > 3.0:
+            chunk = max(chunk // 2, _MIN_CHUNK)
+
+
+def query_all_parallel(layer_query_url: str, out_fields: str,
+                       where: str = "1=1", chunk: int = 5000,
+                       workers: int = 8):
+    """
+    Like query_all, but asks the server for the match count first and
+    then fetches every (offset, chunk) window concurrently. Features are
+    yielded as pages complete, so ordering is not guaranteed.
+    """
+    count_js = get_json(layer_query_url, params={
+        "f": "json",
+        "where": where,
+        "returnCountOnly": "true",
+    })
+    n = count_js.get("count", 0)
+    if not n:
+        return
+
+    def fetch(offset):
+        params = {
+            "f": "json",
+            "where": where,
+            "outFields": out_fields,
+            "returnGeometry": "false",
+            "resultOffset": offset,
+            "resultRecordCount": chunk,
+        }
+        if ijson is not None:
+            return list(get_json_stream(layer_query_url, params=params))
+        return get_json(layer_query_url, params=params).get("features", [])
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch, off) for off in range(0, n, chunk)]
+        for fut in as_completed(futures):
+            for f in fut.result():
+                yield f
 
 
 def batched(iterable, n: int):
@@ -77,30 +351,44 @@ def batched(iterable, n: int):
 
 def apply_updates(
     apply_url: str,
-    updates: List[Dict],
+    updates: Iterable[Dict],
     batch: int = 500,
-    sleep: float = 0.0,
+    workers: int = 4,
 ):
-    if not updates:
-        return 0
+    """
+    POST updates in batches of `batch`, keeping up to `workers` batches
+    in flight. Batches are pulled from `updates` lazily as slots free
+    up, so at most workers + 1 of them are materialized at once even
+    when the caller passes a generator. The edits touch disjoint OIDs,
+    so concurrent batches are safe; 429/503 throttling is absorbed by
+    the session's retry/backoff rather than a fixed inter-batch sleep.
+    """
 
-    total = 0
-    for b in batched(updates, batch):
-        data = {"f": "json", "updates": json.dumps(b)}
+    def _post_batch(b):
+        data = {"f": "json", "updates": _dumps(b)}
         js = get_json(apply_url, method="POST", data=data)
 
         if "error" in js:
             print("applyEdits error:", js["error"])
-            return total
+            return 0
 
-        if "updateResults" in js:
-            successes = [r for r in js["updateResults"] if r.get("success")]
-            total += len(successes)
-        else:
+        if "updateResults" not in js:
             print("applyEdits unexpected response:", js)
-            return total
+            return 0
+
+        return sum(1 for r in js["updateResults"] if r.get("success"))
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for b in batched(updates, batch):
+            if len(pending) >= workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    total += fut.result()
+            pending.add(pool.submit(_post_batch, b))
 
-        if sleep > 0:
-            time.sleep(sleep)
+        for fut in as_completed(pending):
+            total += fut.result()
 
     return total